@@ -0,0 +1,181 @@
+"""
+Admission control for expensive routes.
+
+Every request is assigned a route class by endpoint name. Each (client, route
+class) pair draws from a token bucket, and expensive classes also have a cap
+on in-flight requests in this process. Requests over either limit are shed
+immediately with 429/503 and a Retry-After header instead of queueing.
+
+Token buckets live in process memory by default; set ADMISSION_URL to a
+redis:// URL so all workers draw from the same buckets.
+"""
+import math
+import threading
+import time
+
+from flask import current_app, g, jsonify, request
+
+
+class LocalBucketBackend:
+    """Per-process token buckets"""
+
+    # Idle buckets refill completely, so they can be dropped once there are many
+    MAX_BUCKETS = 10000
+    IDLE_SECONDS = 600
+
+    def __init__(self):
+        self._buckets = {}  # key -> [tokens, last_refill]
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """Take one token; return 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_BUCKETS:
+                    self._prune(now)
+                bucket = self._buckets[key] = [capacity, now]
+            tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+
+    def _prune(self, now):
+        idle = [key for key, (_, last) in self._buckets.items() if now - last > self.IDLE_SECONDS]
+        for key in idle:
+            del self._buckets[key]
+
+
+class RedisBucketBackend:
+    """Token buckets shared by every worker through Redis.
+
+    If Redis is unreachable the request is admitted (fail open) and the error
+    logged; the per-process concurrency caps still bound the load.
+    """
+
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, url, prefix='therapy:admission:'):
+        import redis  # optional dependency, only needed when ADMISSION_URL is set
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._take = self.client.register_script(self.SCRIPT)
+        self.redis_error = redis.RedisError
+        self.errors = 0
+
+    def take(self, key, capacity, rate):
+        try:
+            return float(self._take(keys=[self.prefix + key], args=[capacity, rate, time.time()]))
+        except self.redis_error as e:
+            self.errors += 1
+            current_app.logger.warning('Admission rate limit check failed, admitting: %s', e)
+            return 0
+
+
+class AdmissionController:
+    """Rate limits and concurrency caps applied in before_request"""
+
+    def __init__(self):
+        self.enabled = False
+        self.backend = None
+        self.route_classes = {}
+        self.rate_limits = {}
+        self._slots = {}
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed = 0
+
+    def init_app(self, app):
+        self.enabled = app.config.get('ADMISSION_ENABLED', True)
+        self.route_classes = app.config.get('ADMISSION_ROUTE_CLASSES', {})
+        self.rate_limits = app.config.get('ADMISSION_RATE_LIMITS', {})
+        self._slots = {
+            route_class: threading.BoundedSemaphore(limit)
+            for route_class, limit in app.config.get('ADMISSION_CONCURRENCY', {}).items()
+            if limit
+        }
+        url = app.config.get('ADMISSION_URL')
+        self.backend = RedisBucketBackend(url) if url else LocalBucketBackend()
+
+        app.before_request(self._admit)
+        app.teardown_request(self._release)
+
+    def route_class(self, endpoint):
+        return self.route_classes.get(endpoint, 'default')
+
+    @staticmethod
+    def client_key():
+        """Client address; behind a reverse proxy set PROXY_FIX_X_FOR so this is not the proxy's"""
+        return request.remote_addr or 'unknown'
+
+    def _admit(self):
+        if not self.enabled or request.method == 'OPTIONS' or request.endpoint is None:
+            return None
+        route_class = self.route_class(request.endpoint)
+        if route_class == 'exempt':
+            return None
+
+        limit = self.rate_limits.get(route_class)
+        if limit:
+            capacity, rate = limit
+            wait = self.backend.take(f'{route_class}:{self.client_key()}', capacity, rate)
+            if wait > 0:
+                self.rate_limited += 1
+                return self._reject(429, 'Too many requests', wait)
+
+        slots = self._slots.get(route_class)
+        if slots is not None:
+            if not slots.acquire(blocking=False):
+                self.shed += 1
+                return self._reject(503, 'Server busy, please retry', 1)
+            g.admission_slot = slots
+
+        self.admitted += 1
+        return None
+
+    @staticmethod
+    def _release(exc=None):
+        slots = g.pop('admission_slot', None)
+        if slots is not None:
+            slots.release()
+
+    @staticmethod
+    def _reject(status, message, retry_after):
+        response = jsonify({'error': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'admitted': self.admitted,
+            'rateLimited': self.rate_limited,
+            'shed': self.shed,
+            'backendErrors': getattr(self.backend, 'errors', 0),
+        }
+
+
+admission = AdmissionController()
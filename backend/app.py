@@ -1,12 +1,31 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from flask_cors import CORS
 from dotenv import load_dotenv
 from config import Config
-from models import db, User, Tutor, FamilyUser, Activity, Purchase, Review
+from models import (
+    db, User, Tutor, FamilyUser, Activity, ActivityTag, ActivityRevision, ActivityTombstone, Favorite,
+    Purchase, Review, RatingHistogram,
+    backfill_activity_tags, backfill_favorites, backfill_rating_histograms, create_missing_indexes,
+    add_missing_columns, backfill_content_timestamps, drop_purchase_activity_fk,
+)
+from recommendations import recommendation_index
+from author_cache import profile_cache
+from sales import record_sale, backfill_sales_rollups, rebuild_sales_rollups, tutor_sales, parse_sales_range
+from pagination import page_size, keyset_page
+from admission import admission
+from sync import gzip_stream, parse_known_assets, parse_watermark, sync_records
+from json_provider import FastJSONProvider
+from compression import compressor
+from revisions import (
+    compact_revisions, ensure_base_revision, record_revision, restore_revision, revision_state,
+)
 from datetime import datetime
 import uuid
 import hashlib
 import json
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # Load environment variables from .env file
@@ -14,12 +33,19 @@ load_dotenv()
 
 app = Flask(__name__)
 app.config.from_object(Config)
+app.json = FastJSONProvider(app)
+if app.config['PROXY_FIX_X_FOR']:
+    # Trust X-Forwarded-For from this many proxies so remote_addr is the client
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
 CORS(app, resources={
     r"/api/*": {
         "origins": "http://localhost:8080"
     }
 })
 db.init_app(app)
+profile_cache.init_app(app)
+admission.init_app(app)
+compressor.init_app(app)
 
 # ==================== AUTHENTICATION ROUTES ====================
 
@@ -73,6 +99,7 @@ def signup():
             db.session.add(family)
         
         db.session.commit()
+        profile_cache.invalidate(user_id)
         
         user_dict = user.to_dict()
         if data['role'] == 'tutor':
@@ -204,9 +231,10 @@ def update_user(user_id):
                 if 'selectedTutorId' in data:
                     family.selected_tutor_id = data['selectedTutorId']
                 if 'favoriteActivities' in data:
-                    family.favorite_activities = json.dumps(data['favoriteActivities'])
+                    family.set_favorites(data['favoriteActivities'])
         
         db.session.commit()
+        profile_cache.invalidate(user_id)
         
         user_dict = user.to_dict()
         if user.role == 'tutor':
@@ -235,15 +263,9 @@ def get_tutors():
         if region and region != 'all':
             query = query.filter_by(region=region)
         
-        tutors = query.all()
-        result = []
-        
-        for tutor_user in tutors:
-            tutor_data = tutor_user.to_dict()
-            tutor_details = Tutor.query.get(tutor_user.id)
-            if tutor_details:
-                tutor_data.update(tutor_details.to_dict())
-            result.append(tutor_data)
+        tutor_ids = [row.id for row in query.with_entities(User.id).all()]
+        profiles = profile_cache.get_many(tutor_ids)
+        result = [profiles[tutor_id].profile_dict() for tutor_id in tutor_ids if tutor_id in profiles]
         
         return jsonify({'tutors': result}), 200
     except Exception as e:
@@ -253,16 +275,24 @@ def get_tutors():
 def get_tutor(tutor_id):
     """Get tutor by ID"""
     try:
-        user = User.query.get(tutor_id)
-        if not user or user.role != 'tutor':
+        profile = profile_cache.get(tutor_id)
+        if not profile or profile.role != 'tutor':
             return jsonify({'error': 'Tutor not found'}), 404
         
-        tutor_data = user.to_dict()
-        tutor_details = Tutor.query.get(tutor_id)
-        if tutor_details:
-            tutor_data.update(tutor_details.to_dict())
+        return jsonify({'tutor': profile.profile_dict()}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/tutors/<tutor_id>/sales', methods=['GET'])
+def get_tutor_sales(tutor_id):
+    """Get a tutor's units and revenue over a date range from the daily rollups"""
+    try:
+        try:
+            start, end, granularity = parse_sales_range(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        return jsonify({'tutor': tutor_data}), 200
+        return jsonify({'sales': tutor_sales(tutor_id, start, end, granularity)}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -290,6 +320,8 @@ def get_activities():
         
         activities = query.order_by(Activity.created_at.desc()).all()
         
+        profile_cache.warm(activities)
+        
         return jsonify({
             'activities': [activity.to_dict(include_author=True) for activity in activities]
         }), 200
@@ -329,9 +361,12 @@ def create_activity():
             is_published=data.get('isPublished', False),
             tags=json.dumps(data.get('tags', [])),
         )
+        activity.sync_tag_links()
         
         db.session.add(activity)
+        record_revision(activity)
         db.session.commit()
+        recommendation_index.index_activity(activity)
         
         return jsonify({'activity': activity.to_dict(), 'message': 'Activity created successfully'}), 201
     except Exception as e:
@@ -348,6 +383,8 @@ def update_activity(activity_id):
         if not activity:
             return jsonify({'error': 'Activity not found'}), 404
         
+        ensure_base_revision(activity)
+        
         # Update fields
         if 'title' in data:
             activity.title = data['title']
@@ -357,11 +394,14 @@ def update_activity(activity_id):
             activity.elements = json.dumps(data['elements'])
         if 'tags' in data:
             activity.tags = json.dumps(data['tags'])
+            activity.sync_tag_links()
         if 'language' in data:
             activity.language = data['language']
         
-        activity.updated_at = datetime.utcnow()
+        activity.mark_content_changed()
+        record_revision(activity)
         db.session.commit()
+        recommendation_index.index_activity(activity)
         
         return jsonify({'activity': activity.to_dict(), 'message': 'Activity updated successfully'}), 200
     except Exception as e:
@@ -377,15 +417,98 @@ def delete_activity(activity_id):
             return jsonify({'error': 'Activity not found'}), 404
         
         db.session.delete(activity)
+        db.session.merge(ActivityTombstone(activity_id=activity_id, deleted_at=datetime.utcnow()))
         db.session.commit()
+        recommendation_index.remove_activity(activity_id)
         
         return jsonify({'message': 'Activity deleted successfully'}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# ==================== REVISION ROUTES ====================
+
+@app.route('/api/activities/<activity_id>/revisions', methods=['GET'])
+def get_activity_revisions(activity_id):
+    """List an activity's revisions, newest first (paginate with ?before=<revision>)"""
+    try:
+        if not Activity.query.get(activity_id):
+            return jsonify({'error': 'Activity not found'}), 404
+        
+        limit = page_size(request.args)
+        query = ActivityRevision.query.filter_by(activity_id=activity_id)
+        before = request.args.get('before', type=int)
+        if before is not None:
+            query = query.filter(ActivityRevision.revision < before)
+        revisions = query.order_by(ActivityRevision.revision.desc()).limit(limit + 1).all()
+        
+        has_more = len(revisions) > limit
+        revisions = revisions[:limit]
+        return jsonify({
+            'revisions': [r.to_dict() for r in revisions],
+            'nextBefore': revisions[-1].revision if has_more else None,
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/activities/<activity_id>/revisions/<int:revision>', methods=['GET'])
+def get_activity_revision(activity_id, revision):
+    """Get an activity's content as of a revision"""
+    try:
+        state = revision_state(activity_id, revision)
+        if state is None:
+            return jsonify({'error': 'Revision not found'}), 404
+        
+        return jsonify({'revision': revision, 'content': state}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/activities/<activity_id>/revisions/<int:revision>/restore', methods=['POST'])
+def restore_activity_revision(activity_id, revision):
+    """Restore an activity's content to a revision, recorded as a new revision"""
+    try:
+        activity = Activity.query.get(activity_id)
+        if not activity:
+            return jsonify({'error': 'Activity not found'}), 404
+        
+        state = revision_state(activity_id, revision)
+        if state is None:
+            return jsonify({'error': 'Revision not found'}), 404
+        
+        new_revision = restore_revision(activity, state)
+        activity.sync_tag_links()
+        db.session.commit()
+        recommendation_index.index_activity(activity)
+        
+        return jsonify({
+            'activity': activity.to_dict(),
+            'revision': new_revision,
+            'message': 'Activity restored successfully',
+        }), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 # ==================== MARKETPLACE ROUTES ====================
 
+def _parse_tag_values(raw):
+    """Split a comma-separated filter parameter into normalized tag values"""
+    if not raw:
+        return []
+    return sorted({ActivityTag.normalize(v) for v in raw.split(',') if v.strip()})
+
+def _tag_filter(kind, values, mode):
+    """Subquery of activity ids carrying all (or any) of the given values"""
+    query = db.session.query(ActivityTag.activity_id).filter(
+        ActivityTag.kind == kind,
+        ActivityTag.value.in_(values),
+    )
+    if mode == 'any':
+        return query
+    return query.group_by(ActivityTag.activity_id).having(
+        db.func.count(ActivityTag.value) == len(values)
+    )
+
 @app.route('/api/marketplace/activities', methods=['GET'])
 def get_marketplace_activities():
     """Get published marketplace activities with filters"""
@@ -395,6 +518,8 @@ def get_marketplace_activities():
         activity_type = request.args.get('type')
         price_filter = request.args.get('price')  # 'all', 'free', 'paid'
         search = request.args.get('search')
+        tag_mode = request.args.get('tagMode', 'all')  # 'all' or 'any'
+        child_age = request.args.get('age', type=int)
         
         query = Activity.query.filter_by(is_published=True)
         
@@ -411,6 +536,17 @@ def get_marketplace_activities():
         elif price_filter == 'paid':
             query = query.filter(Activity.pricing_model.in_(['paid', 'institutional']))
         
+        for kind, param in (('tag', 'tags'), ('goal', 'goals'), ('diagnosis', 'diagnoses')):
+            values = _parse_tag_values(request.args.get(param))
+            if values:
+                query = query.filter(Activity.id.in_(_tag_filter(kind, values, tag_mode)))
+        
+        if child_age is not None:
+            query = query.filter(
+                db.or_(Activity.age_min.is_(None), Activity.age_min <= child_age),
+                db.or_(Activity.age_max.is_(None), Activity.age_max >= child_age),
+            )
+        
         if search:
             query = query.filter(
                 (Activity.title.contains(search)) |
@@ -419,6 +555,8 @@ def get_marketplace_activities():
         
         activities = query.order_by(Activity.purchase_count.desc(), Activity.rating.desc()).all()
         
+        profile_cache.warm(activities)
+        
         return jsonify({
             'activities': [activity.to_dict(include_author=True) for activity in activities]
         }), 200
@@ -435,6 +573,8 @@ def publish_activity(activity_id):
         if not activity:
             return jsonify({'error': 'Activity not found'}), 404
         
+        ensure_base_revision(activity)
+        
         # Update marketplace fields
         activity.is_published = True
         activity.price = data.get('price', 0)
@@ -443,20 +583,97 @@ def publish_activity(activity_id):
         activity.age_max = data.get('ageRange', {}).get('max')
         activity.therapy_goals = json.dumps(data.get('therapyGoals', []))
         activity.diagnosis_tags = json.dumps(data.get('diagnosisTags', []))
+        activity.sync_tag_links()
         activity.thumbnail = data.get('thumbnail')
         activity.preview_url = data.get('previewUrl')
         
         if 'description' in data:
             activity.description = data['description']
         
-        activity.updated_at = datetime.utcnow()
+        activity.mark_content_changed()
+        # A changed description is content history like any other edit
+        record_revision(activity)
         db.session.commit()
+        recommendation_index.index_activity(activity)
         
         return jsonify({'activity': activity.to_dict(include_author=True), 'message': 'Activity published successfully'}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# ==================== FAVORITE ROUTES ====================
+
+@app.route('/api/families/<family_id>/favorites', methods=['GET'])
+def get_family_favorites(family_id):
+    """Get a page of a family's favorite activities, most recently added first"""
+    try:
+        if not FamilyUser.query.get(family_id):
+            return jsonify({'error': 'Family not found'}), 404
+        
+        try:
+            favorites, next_cursor = keyset_page(
+                Favorite.query.filter_by(family_id=family_id).options(joinedload(Favorite.activity)),
+                Favorite.created_at,
+                Favorite.activity_id,
+                request.args.get('cursor'),
+                page_size(request.args),
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Warm the author cache for the whole page in one batch
+        profile_cache.warm([f.activity for f in favorites if f.activity])
+        
+        return jsonify({
+            'favorites': [
+                dict(f.to_dict(), activity=f.activity.to_summary_dict())
+                for f in favorites if f.activity
+            ],
+            'nextCursor': next_cursor,
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/families/<family_id>/favorites/<activity_id>', methods=['PUT'])
+def add_favorite(family_id, activity_id):
+    """Add an activity to a family's favorites (idempotent)"""
+    try:
+        if not FamilyUser.query.get(family_id):
+            return jsonify({'error': 'Family not found'}), 404
+        if not Activity.query.get(activity_id):
+            return jsonify({'error': 'Activity not found'}), 404
+        
+        favorite = Favorite.query.get((family_id, activity_id))
+        if favorite:
+            return jsonify({'favorite': favorite.to_dict(), 'message': 'Already in favorites'}), 200
+        
+        favorite = Favorite(family_id=family_id, activity_id=activity_id)
+        db.session.add(favorite)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Added concurrently from another device
+            db.session.rollback()
+            favorite = Favorite.query.get((family_id, activity_id))
+            return jsonify({'favorite': favorite.to_dict(), 'message': 'Already in favorites'}), 200
+        
+        return jsonify({'favorite': favorite.to_dict(), 'message': 'Added to favorites'}), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/families/<family_id>/favorites/<activity_id>', methods=['DELETE'])
+def remove_favorite(family_id, activity_id):
+    """Remove an activity from a family's favorites (idempotent)"""
+    try:
+        Favorite.query.filter_by(family_id=family_id, activity_id=activity_id).delete()
+        db.session.commit()
+        
+        return jsonify({'message': 'Removed from favorites'}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 # ==================== PURCHASE ROUTES ====================
 
 @app.route('/api/purchases', methods=['POST'])
@@ -489,13 +706,16 @@ def create_purchase():
             user_id=data['userId'],
             activity_id=data['activityId'],
             price=activity.price,
+            purchased_at=datetime.utcnow(),
         )
         
         # Update activity purchase count
         activity.purchase_count += 1
         
         db.session.add(purchase)
+        record_sale(purchase, activity)
         db.session.commit()
+        recommendation_index.record_purchase(purchase.user_id, purchase.activity_id)
         
         return jsonify({'purchase': purchase.to_dict(), 'message': 'Purchase successful'}), 201
     except Exception as e:
@@ -508,17 +728,49 @@ def get_user_purchases(user_id):
     try:
         purchases = Purchase.query.filter_by(user_id=user_id).order_by(Purchase.purchased_at.desc()).all()
         
-        # Get activities for purchases
-        activities = []
-        for purchase in purchases:
-            activity = Activity.query.get(purchase.activity_id)
-            if activity:
-                activities.append(activity.to_dict(include_author=True))
+        # Get activities for purchases in one query, then their authors in one batch
+        purchased = {
+            a.id: a for a in Activity.query.filter(Activity.id.in_([p.activity_id for p in purchases])).all()
+        } if purchases else {}
+        profile_cache.warm(purchased.values())
+        activities = [
+            purchased[p.activity_id].to_dict(include_author=True)
+            for p in purchases if p.activity_id in purchased
+        ]
         
         return jsonify({'purchases': [p.to_dict() for p in purchases], 'activities': activities}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/purchases/user/<user_id>/sync', methods=['GET', 'POST'])
+def sync_user_purchases(user_id):
+    """Stream purchased activities changed since a watermark as an NDJSON bundle"""
+    try:
+        try:
+            since = parse_watermark(request.args.get('since'))
+        except ValueError:
+            return jsonify({'error': "'since' must be an ISO timestamp"}), 400
+        
+        # Asset ids the device already holds: ?knownAssets=a,b or a POST body
+        # {"knownAssets": [...]} when the list is too long for a URL
+        known = request.args.getlist('knownAssets')
+        if request.method == 'POST':
+            body = request.get_json(silent=True) or {}
+            if not isinstance(body.get('knownAssets', []), list):
+                return jsonify({'error': "'knownAssets' must be a list of asset ids"}), 400
+            known += body.get('knownAssets', [])
+        
+        records = stream_with_context(sync_records(user_id, since, parse_known_assets(known)))
+        headers = {'Cache-Control': 'no-store'}
+        # Bundles are compressed while they stream, which only gzip_stream supports
+        if compressor.choose_encoding(request.headers.get('Accept-Encoding'), supported=('gzip',)) == 'gzip':
+            headers['Content-Encoding'] = 'gzip'
+            records = gzip_stream(records)
+        
+        return Response(records, mimetype='application/x-ndjson', headers=headers)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/purchases/check/<user_id>/<activity_id>', methods=['GET'])
 def check_purchase(user_id, activity_id):
     """Check if user has purchased an activity"""
@@ -532,10 +784,26 @@ def check_purchase(user_id, activity_id):
 
 @app.route('/api/reviews/activity/<activity_id>', methods=['GET'])
 def get_activity_reviews(activity_id):
-    """Get reviews for an activity"""
+    """Get a page of reviews for an activity, newest first, with its rating histogram"""
     try:
-        reviews = Review.query.filter_by(activity_id=activity_id).order_by(Review.created_at.desc()).all()
-        return jsonify({'reviews': [r.to_dict() for r in reviews]}), 200
+        try:
+            reviews, next_cursor = keyset_page(
+                Review.query.filter_by(activity_id=activity_id),
+                Review.created_at,
+                Review.id,
+                request.args.get('cursor'),
+                page_size(request.args),
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        histogram = RatingHistogram.query.get(activity_id) or RatingHistogram(activity_id=activity_id)
+        
+        return jsonify({
+            'reviews': [r.to_dict() for r in reviews],
+            'nextCursor': next_cursor,
+            'histogram': histogram.to_dict(),
+        }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -549,11 +817,13 @@ def create_review():
             return jsonify({'error': 'Missing required fields'}), 400
         
         # Validate rating
+        if not isinstance(data['rating'], int) or isinstance(data['rating'], bool):
+            return jsonify({'error': 'Rating must be a whole number of stars'}), 400
         if not (1 <= data['rating'] <= 5):
             return jsonify({'error': 'Rating must be between 1 and 5'}), 400
         
         # Get user name
-        user = User.query.get(data['userId'])
+        user = profile_cache.get(data['userId'])
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
@@ -569,35 +839,119 @@ def create_review():
         
         db.session.add(review)
         
-        # Update activity rating
+        # Update activity rating from the histogram instead of rescanning reviews
         activity = Activity.query.get(data['activityId'])
         if activity:
-            # Recalculate average rating
-            all_reviews = Review.query.filter_by(activity_id=data['activityId']).all()
-            if all_reviews:
-                activity.rating = sum(r.rating for r in all_reviews) / len(all_reviews)
-                activity.review_count = len(all_reviews)
+            histogram = RatingHistogram.record(data['activityId'], data['rating']).to_dict()
+            activity.rating = histogram['average']
+            activity.review_count = histogram['total']
         
         db.session.commit()
+        if activity:
+            recommendation_index.index_activity(activity)
         
         return jsonify({'review': review.to_dict(), 'message': 'Review created successfully'}), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# ==================== RECOMMENDATION ROUTES ====================
+
+def _hydrate_ranked(ranked):
+    """Load ranked (activity_id, score) pairs as listing summaries in one query, preserving order"""
+    ids = [activity_id for activity_id, _ in ranked]
+    if not ids:
+        return []
+    activities = {a.id: a for a in Activity.query.filter(Activity.id.in_(ids)).all()}
+    profile_cache.warm(activities.values())
+    result = []
+    for activity_id, score in ranked:
+        activity = activities.get(activity_id)
+        if activity:
+            result.append(dict(activity.to_summary_dict(), score=round(score, 4)))
+    return result
+
+@app.route('/api/activities/<activity_id>/similar', methods=['GET'])
+def get_similar_activities(activity_id):
+    """Get published activities similar to an activity"""
+    try:
+        limit = min(page_size(request.args, default=10), 50)
+        ranked = recommendation_index.similar(activity_id, limit=limit)
+        if ranked is None:
+            return jsonify({'error': 'Activity not found'}), 404
+        
+        return jsonify({'activities': _hydrate_ranked(ranked)}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/families/<family_id>/recommendations', methods=['GET'])
+def get_family_recommendations(family_id):
+    """Get recommended activities for a family"""
+    try:
+        family = FamilyUser.query.get(family_id)
+        if not family:
+            return jsonify({'error': 'Family not found'}), 404
+        
+        limit = min(page_size(request.args, default=10), 50)
+        ranked = recommendation_index.recommend_for_family(family, limit=limit)
+        
+        return jsonify({'activities': _hydrate_ranked(ranked)}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # ==================== INITIALIZATION ====================
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'message': 'API is running'}), 200
+    return jsonify({'status': 'healthy', 'message': 'API is running', 'admission': admission.stats()}), 200
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit rates and sizes of the in-process caches"""
+    return jsonify({'authors': profile_cache.stats(), 'compression': compressor.stats()}), 200
 
 def init_db():
     """Initialize database"""
     with app.app_context():
         db.create_all()
+        for column in add_missing_columns():
+            print(f"Added column {column}")
+        create_missing_indexes()
+        if drop_purchase_activity_fk():
+            print("Dropped the purchases -> activities foreign key")
+        backfilled = backfill_content_timestamps()
+        if backfilled:
+            print(f"Backfilled content timestamps for {backfilled} activities")
+        backfilled = backfill_activity_tags()
+        if backfilled:
+            print(f"Backfilled tags for {backfilled} activities")
+        backfilled = backfill_favorites()
+        if backfilled:
+            print(f"Migrated favorites for {backfilled} families")
+        backfilled = backfill_rating_histograms()
+        if backfilled:
+            print(f"Backfilled rating histograms for {backfilled} activities")
+        backfilled = backfill_sales_rollups()
+        if backfilled:
+            print(f"Backfilled {backfilled} sales rollup rows")
         print("Database initialized successfully!")
 
+@app.cli.command('rebuild-sales-rollups')
+def rebuild_sales_rollups_command():
+    """Recompute tutor sales rollups from the purchases table"""
+    rows = rebuild_sales_rollups()
+    print(f"Rebuilt {rows} sales rollup rows")
+
+@app.cli.command('compact-revisions')
+def compact_revisions_command():
+    """Thin old activity revisions and re-encode their snapshot/delta chains"""
+    removed = 0
+    for (activity_id,) in db.session.query(ActivityRevision.activity_id).distinct().all():
+        removed += compact_revisions(activity_id)
+        db.session.commit()
+    print(f"Removed {removed} activity revisions")
+
 if __name__ == '__main__':
     init_db()
     app.run(debug=app.config['DEBUG'], host=app.config['HOST'], port=app.config['PORT'])
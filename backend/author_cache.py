@@ -0,0 +1,270 @@
+"""
+Process-wide cache of author/profile records.
+
+Tutor profiles are read far more often than they change (activity listings,
+tutor pages, reviews), so they are cached as compact records in a bounded LRU
+with a TTL. Entries are invalidated by signup and update_user. Set
+AUTHOR_CACHE_URL to a redis:// URL to share entries across worker processes.
+"""
+from collections import OrderedDict
+import json
+import threading
+import time
+
+from flask import current_app
+
+from models import User, Tutor
+
+
+class ProfileRecord:
+    """Compact, immutable author/profile record (no login or session state)"""
+
+    __slots__ = (
+        'id', 'email', 'name', 'role', 'region', 'avatar', 'created_at',
+        'specialization', 'experience', 'qualifications', 'bio', 'rating',
+        'total_students', 'total_activities', 'verified',
+    )
+
+    # Tutor-only fields, as named in Tutor.to_dict()
+    TUTOR_FIELDS = (
+        ('specialization', 'specialization'),
+        ('experience', 'experience'),
+        ('qualifications', 'qualifications'),
+        ('bio', 'bio'),
+        ('rating', 'rating'),
+        ('total_students', 'totalStudents'),
+        ('total_activities', 'totalActivities'),
+        ('verified', 'verified'),
+    )
+
+    def __init__(self, data):
+        """Build from a profile_dict()-shaped mapping"""
+        self.id = data['id']
+        self.email = data.get('email')
+        self.name = data['name']
+        self.role = data['role']
+        self.region = data.get('region')
+        self.avatar = data.get('avatar')
+        self.created_at = data.get('createdAt')
+        for slot, key in self.TUTOR_FIELDS:
+            setattr(self, slot, data.get(key))
+
+    @classmethod
+    def from_models(cls, user, tutor=None):
+        data = {
+            'id': user.id,
+            'email': user.email,
+            'name': user.name,
+            'role': user.role,
+            'region': user.region,
+            'avatar': user.avatar,
+            'createdAt': user.created_at,
+        }
+        if tutor is not None:
+            data.update(tutor.to_dict())
+        return cls(data)
+
+    def author_dict(self):
+        """Author summary embedded in Activity.to_dict(include_author=True)"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'region': self.region,
+            'avatar': self.avatar,
+            'rating': self.rating if self.role == 'tutor' else None,
+        }
+
+    def profile_dict(self):
+        data = {
+            'id': self.id,
+            'email': self.email,
+            'name': self.name,
+            'role': self.role,
+            'region': self.region,
+            'avatar': self.avatar,
+            'createdAt': self.created_at,
+        }
+        if self.role == 'tutor':
+            for slot, key in self.TUTOR_FIELDS:
+                data[key] = getattr(self, slot)
+        return data
+
+
+class LocalLRUBackend:
+    """Bounded in-process LRU with per-entry expiry"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (expires_at, record)
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, record = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return record
+
+    def set(self, key, record):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, record)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'backend': 'local',
+            'size': len(self._entries),
+            'maxSize': self.max_size,
+            'ttl': self.ttl,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class RedisBackend:
+    """Shared backend so every worker sees the same entries and invalidations.
+
+    Redis errors are logged and treated as misses, so an outage falls back to
+    the database instead of failing the request.
+    """
+
+    def __init__(self, url, ttl, prefix='therapy:profile:'):
+        import redis  # optional dependency, only needed when AUTHOR_CACHE_URL is set
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.redis_error = redis.RedisError
+        self.errors = 0
+
+    def _failed(self, operation, error):
+        self.errors += 1
+        current_app.logger.warning('Profile cache %s failed: %s', operation, error)
+
+    def get(self, key):
+        try:
+            raw = self.client.get(self.prefix + key)
+        except self.redis_error as e:
+            self._failed('get', e)
+            return None
+        return ProfileRecord(json.loads(raw)) if raw else None
+
+    def set(self, key, record):
+        try:
+            self.client.set(self.prefix + key, current_app.json.dumps(record.profile_dict()), ex=self.ttl)
+        except self.redis_error as e:
+            self._failed('set', e)
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except self.redis_error as e:
+            # The stale entry expires after the TTL
+            self._failed('delete', e)
+
+    def clear(self):
+        try:
+            for key in self.client.scan_iter(self.prefix + '*'):
+                self.client.delete(key)
+        except self.redis_error as e:
+            self._failed('clear', e)
+
+    def stats(self):
+        return {'backend': 'redis', 'ttl': self.ttl, 'errors': self.errors}
+
+
+def load_profiles(user_ids):
+    """Load {user_id: ProfileRecord} from the database in two queries"""
+    if not user_ids:
+        return {}
+    users = User.query.filter(User.id.in_(user_ids)).all()
+    tutor_ids = [u.id for u in users if u.role == 'tutor']
+    tutors = {t.id: t for t in Tutor.query.filter(Tutor.id.in_(tutor_ids)).all()} if tutor_ids else {}
+
+    return {user.id: ProfileRecord.from_models(user, tutors.get(user.id)) for user in users}
+
+
+class ProfileCache:
+    """Read-through cache of ProfileRecords with hit-rate instrumentation"""
+
+    def __init__(self):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        ttl = app.config.get('AUTHOR_CACHE_TTL', 300)
+        url = app.config.get('AUTHOR_CACHE_URL')
+        if url:
+            self.backend = RedisBackend(url, ttl)
+        else:
+            self.backend = LocalLRUBackend(app.config.get('AUTHOR_CACHE_SIZE', 1024), ttl)
+
+    def get(self, user_id):
+        """Return the ProfileRecord for user_id, or None if the user does not exist"""
+        return self.get_many([user_id]).get(user_id)
+
+    def get_many(self, user_ids):
+        records = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            record = self.backend.get(user_id)
+            if record is None:
+                missing.append(user_id)
+            else:
+                records[user_id] = record
+        self.hits += len(records)
+        self.misses += len(missing)
+
+        if missing:
+            loaded = load_profiles(missing)
+            for user_id, record in loaded.items():
+                self.backend.set(user_id, record)
+            records.update(loaded)
+        return records
+
+    def warm(self, activities):
+        """Batch-load the authors of a page of activities before serializing it"""
+        return self.get_many([activity.author_id for activity in activities])
+
+    def invalidate(self, user_id):
+        self.backend.delete(user_id)
+        self.invalidations += 1
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        data = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': round(self.hits / lookups, 4) if lookups else None,
+            'invalidations': self.invalidations,
+        }
+        data.update(self.backend.stats())
+        return data
+
+
+profile_cache = ProfileCache()
@@ -0,0 +1,152 @@
+"""
+Response compression negotiated through Accept-Encoding.
+
+Buffered JSON/text responses at or above COMPRESS_MIN_SIZE are compressed
+with brotli (when the optional brotli package is installed and the client
+accepts it) or gzip. Compressed bodies are kept in an LRU keyed by a digest
+of the uncompressed body, so identical listing responses served repeatedly
+are only compressed once. The LRU is bounded by COMPRESS_CACHE_BYTES of
+compressed data, and bodies above COMPRESS_CACHE_MAX_ENTRY are not cached.
+"""
+from collections import OrderedDict
+import gzip
+import hashlib
+import threading
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/html')
+
+
+def parse_accept_encoding(header):
+    """Return {encoding: q} from an Accept-Encoding header"""
+    accepted = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+class Compressor:
+    """after_request hook that compresses eligible responses"""
+
+    def __init__(self):
+        self.enabled = False
+        self.min_size = 1024
+        self.gzip_level = 6
+        self.brotli_quality = 4
+        self.cache_bytes = 16 * 1024 * 1024
+        self.cache_max_entry = 1024 * 1024
+        self._cache = OrderedDict()  # (digest, encoding) -> compressed body
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def init_app(self, app):
+        self.enabled = app.config.get('COMPRESS_ENABLED', True)
+        if not self.enabled:
+            return
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', self.min_size)
+        self.gzip_level = app.config.get('COMPRESS_GZIP_LEVEL', self.gzip_level)
+        self.brotli_quality = app.config.get('COMPRESS_BROTLI_QUALITY', self.brotli_quality)
+        self.cache_bytes = app.config.get('COMPRESS_CACHE_BYTES', self.cache_bytes)
+        self.cache_max_entry = app.config.get('COMPRESS_CACHE_MAX_ENTRY', self.cache_max_entry)
+        app.after_request(self._compress_response)
+
+    def choose_encoding(self, header, supported=('br', 'gzip')):
+        """Return the preferred acceptable encoding among supported, or None for identity"""
+        if not self.enabled:
+            return None
+        accepted = parse_accept_encoding(header)
+        wildcard = accepted.get('*', 0.0)
+        candidates = [e for e in supported if e != 'br' or brotli is not None]
+        best = None
+        best_q = 0.0
+        for encoding in candidates:
+            q = accepted.get(encoding, wildcard)
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def _compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    def compressed(self, body, encoding):
+        """Compress body, reusing a cached result for an identical body"""
+        if len(body) > self.cache_max_entry:
+            return self._compress(body, encoding)
+        key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return cached
+        data = self._compress(body, encoding)
+        with self._lock:
+            self.cache_misses += 1
+            if key not in self._cache:
+                self._cache[key] = data
+                self._cached_bytes += len(data)
+            while self._cached_bytes > self.cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+        return data
+
+    def _compress_response(self, response):
+        response.vary.add('Accept-Encoding')
+        if (
+            response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        ):
+            return response
+
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+        encoding = self.choose_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+
+        data = self.compressed(body, encoding)
+        self.bytes_in += len(body)
+        self.bytes_out += len(data)
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    def stats(self):
+        return {
+            'brotli': brotli is not None,
+            'cacheHits': self.cache_hits,
+            'cacheMisses': self.cache_misses,
+            'cacheBytes': self._cached_bytes,
+            'bytesIn': self.bytes_in,
+            'bytesOut': self.bytes_out,
+        }
+
+
+compressor = Compressor()
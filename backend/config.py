@@ -13,6 +13,70 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or f'sqlite:///{basedir}/therapy_weaver.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Author/profile cache: bounded LRU with TTL, or shared Redis when a URL is set
+    AUTHOR_CACHE_SIZE = int(os.environ.get('AUTHOR_CACHE_SIZE', 1024))
+    AUTHOR_CACHE_TTL = int(os.environ.get('AUTHOR_CACHE_TTL', 300))
+    AUTHOR_CACHE_URL = os.environ.get('AUTHOR_CACHE_URL')
+    
+    # Admission control: token buckets per client and route class, plus
+    # in-flight caps on expensive routes. Set ADMISSION_URL to a redis:// URL
+    # to share buckets across workers.
+    ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'True').lower() == 'true'
+    ADMISSION_URL = os.environ.get('ADMISSION_URL')
+    # Number of reverse proxies in front of the app. Clients are keyed by
+    # remote address, so behind a proxy this must be set for X-Forwarded-For
+    # to be trusted (0 keys every request by the proxy's address).
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+    ADMISSION_ROUTE_CLASSES = {
+        'login': 'auth',
+        'signup': 'auth',
+        'get_all_users': 'expensive',
+        'get_activities': 'expensive',
+        'get_marketplace_activities': 'expensive',
+        'get_user_purchases': 'expensive',
+        'sync_user_purchases': 'expensive',
+        'get_family_recommendations': 'expensive',
+        'get_similar_activities': 'expensive',
+        'get_tutor_sales': 'expensive',
+        'get_family_favorites': 'expensive',
+        'get_activity_revisions': 'expensive',
+        'get_activity_revision': 'expensive',
+        'restore_activity_revision': 'expensive',
+        'health_check': 'exempt',
+    }
+    # route class -> (burst size, tokens refilled per second)
+    ADMISSION_RATE_LIMITS = {
+        'auth': (int(os.environ.get('ADMISSION_AUTH_BURST', 10)), float(os.environ.get('ADMISSION_AUTH_RATE', 0.2))),
+        'expensive': (int(os.environ.get('ADMISSION_EXPENSIVE_BURST', 20)), float(os.environ.get('ADMISSION_EXPENSIVE_RATE', 2))),
+        'default': (int(os.environ.get('ADMISSION_DEFAULT_BURST', 100)), float(os.environ.get('ADMISSION_DEFAULT_RATE', 20))),
+    }
+    # route class -> max in-flight requests per process
+    ADMISSION_CONCURRENCY = {
+        'auth': int(os.environ.get('ADMISSION_AUTH_CONCURRENCY', 4)),
+        'expensive': int(os.environ.get('ADMISSION_EXPENSIVE_CONCURRENCY', 8)),
+    }
+    
+    # Recommendation index: how often each worker catches up on writes
+    # committed by other workers
+    RECOMMENDATION_REFRESH_SECONDS = float(os.environ.get('RECOMMENDATION_REFRESH_SECONDS', 5))
+    
+    # Activity revision history
+    REVISION_SNAPSHOT_INTERVAL = int(os.environ.get('REVISION_SNAPSHOT_INTERVAL', 20))
+    REVISION_RETENTION_DAYS = int(os.environ.get('REVISION_RETENTION_DAYS', 30))
+    
+    # Offline sync: the returned watermark lags the sync start by this many
+    # seconds so transactions committing during a sync are not skipped
+    SYNC_WATERMARK_OVERLAP = int(os.environ.get('SYNC_WATERMARK_OVERLAP', 60))
+    
+    # Response compression (brotli is used when the optional package is installed)
+    COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', 'True').lower() == 'true'
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+    COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+    # Compressed-body cache: total bytes kept, and the largest body worth caching
+    COMPRESS_CACHE_BYTES = int(os.environ.get('COMPRESS_CACHE_BYTES', 16 * 1024 * 1024))
+    COMPRESS_CACHE_MAX_ENTRY = int(os.environ.get('COMPRESS_CACHE_MAX_ENTRY', 1024 * 1024))
+    
     # CORS Configuration
     CORS_ORIGINS = os.environ.get('CORS_ORIGINS', 'http://localhost:8080,http://localhost:3000,http://127.0.0.1:5173').split(',')
     
@@ -0,0 +1,55 @@
+"""
+Fast JSON provider for the Flask app.
+
+Uses orjson when it is installed and falls back to the stdlib encoder
+otherwise. Both serialize datetime and date values as ISO 8601 strings, so
+model to_dict methods can return them as-is instead of formatting each field.
+"""
+from datetime import date
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+def _default(obj):
+    # Flask's default would format dates as HTTP dates; everything else
+    # (Decimal, UUID, dataclasses, __html__) keeps Flask's handling
+    if isinstance(obj, date):
+        return obj.isoformat()
+    return DefaultJSONProvider.default(obj)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """DefaultJSONProvider with ISO dates and an orjson fast path"""
+
+    default = staticmethod(_default)
+
+    def _orjson_options(self, indent=False):
+        options = orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._orjson_options()).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(obj, default=self.default, option=self._orjson_options(indent)) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
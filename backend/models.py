@@ -1,9 +1,23 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import MetaData, Table, inspect, text
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.schema import DropConstraint
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 import json
 
 db = SQLAlchemy()
 
+def load_json_list(value):
+    """Parse a JSON array column, treating NULL, 'null' and non-arrays as empty"""
+    if not value:
+        return []
+    try:
+        items = json.loads(value)
+    except (TypeError, ValueError):
+        return []
+    return items if isinstance(items, list) else []
+
 class User(db.Model):
     __tablename__ = 'users'
     
@@ -30,8 +44,8 @@ class User(db.Model):
             'role': self.role,
             'region': self.region,
             'avatar': self.avatar,
-            'createdAt': self.created_at.isoformat() if self.created_at else None,
-            'lastLoginAt': self.last_login_at.isoformat() if self.last_login_at else None,
+            'createdAt': self.created_at,
+            'lastLoginAt': self.last_login_at,
         }
 
 class Tutor(db.Model):
@@ -67,7 +81,28 @@ class FamilyUser(db.Model):
     child_name = db.Column(db.String(100), nullable=True)
     child_age = db.Column(db.Integer, nullable=True)
     selected_tutor_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=True)
-    favorite_activities = db.Column(db.Text, nullable=True)  # JSON array
+    favorite_activities = db.Column(db.Text, nullable=True)  # Legacy JSON array, migrated to favorites
+    
+    def favorite_ids(self):
+        rows = (
+            db.session.query(Favorite.activity_id)
+            .filter_by(family_id=self.id)
+            .order_by(Favorite.created_at.desc(), Favorite.activity_id.desc())
+            .all()
+        )
+        return [activity_id for (activity_id,) in rows]
+    
+    def set_favorites(self, activity_ids):
+        """Replace the favorites set, keeping rows (and their timestamps) that remain"""
+        known = {a for (a,) in db.session.query(Activity.id).filter(Activity.id.in_(activity_ids))}
+        wanted = [a for a in dict.fromkeys(activity_ids) if a in known]
+        existing = {f.activity_id: f for f in Favorite.query.filter_by(family_id=self.id).all()}
+        for activity_id, favorite in existing.items():
+            if activity_id not in wanted:
+                db.session.delete(favorite)
+        for activity_id in wanted:
+            if activity_id not in existing:
+                db.session.add(Favorite(family_id=self.id, activity_id=activity_id))
     
     def to_dict(self):
         return {
@@ -75,7 +110,7 @@ class FamilyUser(db.Model):
             'childName': self.child_name,
             'childAge': self.child_age,
             'selectedTutorId': self.selected_tutor_id,
-            'favoriteActivities': json.loads(self.favorite_activities) if self.favorite_activities else [],
+            'favoriteActivities': self.favorite_ids(),
         }
 
 class Activity(db.Model):
@@ -92,6 +127,9 @@ class Activity(db.Model):
     tags = db.Column(db.Text, nullable=True)  # JSON array
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Last change to what offline copies hold (content and listing fields);
+    # purchase and review counters bump updated_at but not this
+    content_updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=True)
     
     # Marketplace fields
     price = db.Column(db.Float, default=0.0)
@@ -107,8 +145,62 @@ class Activity(db.Model):
     diagnosis_tags = db.Column(db.Text, nullable=True)  # JSON array
     
     # Relationships
-    purchases = db.relationship('Purchase', backref='activity', lazy=True)
-    reviews = db.relationship('Review', backref='activity', lazy=True)
+    # Purchases outlive a deleted activity: they are the buyer's record, and sync
+    # reports the deletion to their devices through ActivityTombstone
+    purchases = db.relationship(
+        'Purchase', backref='activity', lazy=True, passive_deletes='all',
+        primaryjoin='Activity.id == foreign(Purchase.activity_id)',
+    )
+    reviews = db.relationship('Review', backref='activity', lazy=True, cascade='all, delete-orphan')
+    rating_histogram = db.relationship('RatingHistogram', uselist=False, lazy=True, cascade='all, delete-orphan')
+    tag_links = db.relationship('ActivityTag', backref='activity', lazy=True, cascade='all, delete-orphan')
+    favorites = db.relationship('Favorite', backref='activity', lazy=True, cascade='all, delete-orphan')
+    revisions = db.relationship('ActivityRevision', backref='activity', lazy='dynamic', cascade='all, delete-orphan')
+    
+    __table_args__ = (
+        db.Index('ix_activities_published_age', 'is_published', 'age_min', 'age_max'),
+    )
+    
+    def sync_tag_links(self):
+        """Mirror the JSON tag columns into the normalized activity_tags rows"""
+        wanted = set()
+        for kind, column in ActivityTag.KIND_COLUMNS.items():
+            for value in load_json_list(getattr(self, column)):
+                normalized = ActivityTag.normalize(value)
+                if normalized:
+                    wanted.add((kind, normalized))
+        
+        for link in list(self.tag_links):
+            if (link.kind, link.value) in wanted:
+                wanted.discard((link.kind, link.value))
+            else:
+                self.tag_links.remove(link)
+        for kind, value in wanted:
+            self.tag_links.append(ActivityTag(kind=kind, value=value))
+    
+    def mark_content_changed(self):
+        """Stamp an edit by the author; offline sync re-sends activities by this time"""
+        self.updated_at = self.content_updated_at = datetime.utcnow()
+    
+    def to_summary_dict(self):
+        """Listing card fields only, without the elements payload"""
+        from author_cache import profile_cache
+        author = profile_cache.get(self.author_id)
+        return {
+            'id': self.id,
+            'title': self.title,
+            'type': self.type,
+            'language': self.language,
+            'authorId': self.author_id,
+            'author': author.author_dict() if author else None,
+            'thumbnail': self.thumbnail,
+            'price': self.price,
+            'pricingModel': self.pricing_model,
+            'rating': self.rating,
+            'reviewCount': self.review_count,
+            'ageRange': {'min': self.age_min, 'max': self.age_max} if self.age_min and self.age_max else None,
+            'isPublished': self.is_published,
+        }
     
     def to_dict(self, include_author=False):
         data = {
@@ -121,8 +213,8 @@ class Activity(db.Model):
             'authorId': self.author_id,
             'isPublished': self.is_published,
             'tags': json.loads(self.tags) if self.tags else [],
-            'createdAt': self.created_at.isoformat() if self.created_at else None,
-            'updatedAt': self.updated_at.isoformat() if self.updated_at else None,
+            'createdAt': self.created_at,
+            'updatedAt': self.updated_at,
             'price': self.price,
             'pricingModel': self.pricing_model,
             'purchaseCount': self.purchase_count,
@@ -136,34 +228,286 @@ class Activity(db.Model):
         }
         
         if include_author:
-            author = User.query.get(self.author_id)
+            from author_cache import profile_cache
+            author = profile_cache.get(self.author_id)
             if author:
-                data['author'] = {
-                    'id': author.id,
-                    'name': author.name,
-                    'region': author.region,
-                    'avatar': author.avatar,
-                    'rating': getattr(Tutor.query.get(author.id), 'rating', None) if author.role == 'tutor' else None,
-                }
+                data['author'] = author.author_dict()
         
         return data
 
+class ActivityTag(db.Model):
+    __tablename__ = 'activity_tags'
+    
+    # kind -> Activity JSON column it is derived from
+    KIND_COLUMNS = {
+        'tag': 'tags',
+        'goal': 'therapy_goals',
+        'diagnosis': 'diagnosis_tags',
+    }
+    
+    activity_id = db.Column(db.String(50), db.ForeignKey('activities.id'), primary_key=True)
+    kind = db.Column(db.String(20), primary_key=True)  # 'tag', 'goal' or 'diagnosis'
+    value = db.Column(db.String(100), primary_key=True)
+    
+    __table_args__ = (
+        db.Index('ix_activity_tags_kind_value', 'kind', 'value', 'activity_id'),
+    )
+    
+    @staticmethod
+    def normalize(value):
+        return value.strip().lower()[:100] if isinstance(value, str) else None
+
+def increment_counters(model, keys, increments, values=None):
+    """
+    Atomically add increments to the row identified by keys, inserting it
+    (with values) if it does not exist yet. The caller commits.
+    """
+    table = model.__table__
+    row = dict(keys, **(values or {}), **increments)
+    dialect = db.session.get_bind().dialect.name
+    
+    if dialect in ('sqlite', 'postgresql'):
+        insert = (sqlite.insert if dialect == 'sqlite' else postgresql.insert)(table).values(**row)
+        db.session.execute(insert.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={column: table.c[column] + insert.excluded[column] for column in increments},
+        ))
+    elif dialect in ('mysql', 'mariadb'):
+        insert = mysql.insert(table).values(**row)
+        db.session.execute(insert.on_duplicate_key_update(
+            {column: table.c[column] + insert.inserted[column] for column in increments}
+        ))
+    else:
+        def update():
+            return db.session.execute(
+                table.update().where(*[table.c[k] == v for k, v in keys.items()]).values(
+                    {column: table.c[column] + amount for column, amount in increments.items()}
+                )
+            ).rowcount
+        if not update():
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(table.insert().values(**row))
+            except IntegrityError:
+                # Inserted concurrently by another transaction
+                update()
+
+def backfill_activity_tags():
+    """Populate activity_tags for activities written before the table existed"""
+    linked = db.session.query(ActivityTag.activity_id)
+    has_values = db.or_(*[
+        db.and_(getattr(Activity, column).isnot(None), getattr(Activity, column).notin_(['[]', 'null']))
+        for column in ActivityTag.KIND_COLUMNS.values()
+    ])
+    activities = Activity.query.filter(has_values, ~Activity.id.in_(linked)).all()
+    for activity in activities:
+        activity.sync_tag_links()
+    db.session.commit()
+    return len(activities)
+
+def backfill_rating_histograms():
+    """Build histograms for activities reviewed before rating_histograms existed"""
+    existing = db.session.query(RatingHistogram.activity_id)
+    rows = (
+        db.session.query(Review.activity_id, Review.rating, db.func.count(Review.id))
+        .filter(~Review.activity_id.in_(existing))
+        .group_by(Review.activity_id, Review.rating)
+        .all()
+    )
+    histograms = {}
+    for activity_id, rating, count in rows:
+        histogram = histograms.setdefault(activity_id, RatingHistogram(activity_id=activity_id))
+        if 1 <= rating <= 5:
+            setattr(histogram, f'stars_{rating}', count)
+    db.session.add_all(histograms.values())
+    db.session.commit()
+    return len(histograms)
+
+def add_missing_columns():
+    """create_all() skips new columns of tables that already exist, so add them here (nullable only)"""
+    inspector = inspect(db.engine)
+    added = []
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                added.append(f'{table.name}.{column.name}')
+    return added
+
+def backfill_content_timestamps():
+    """Start content_updated_at from updated_at for activities that predate it"""
+    updated = Activity.query.filter(Activity.content_updated_at.is_(None)).update(
+        # updated_at is set to itself so its onupdate default does not fire
+        {Activity.content_updated_at: Activity.updated_at, Activity.updated_at: Activity.updated_at},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return updated
+
+def create_missing_indexes():
+    """create_all() skips indexes on tables that already exist, so add them here"""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+def drop_purchase_activity_fk():
+    """Drop the purchases -> activities foreign key left in databases created before purchases outlived activities"""
+    if db.engine.dialect.name == 'sqlite':
+        return 0  # SQLite cannot drop constraints in place and only enforces them when enabled
+    purchases = Table('purchases', MetaData(), autoload_with=db.engine)
+    legacy = [fk for fk in purchases.foreign_key_constraints if fk.referred_table.name == 'activities']
+    with db.engine.begin() as connection:
+        for constraint in legacy:
+            connection.execute(DropConstraint(constraint))
+    return len(legacy)
+
+class Favorite(db.Model):
+    __tablename__ = 'favorites'
+    
+    # The composite primary key is the unique (family, activity) index
+    family_id = db.Column(db.String(50), db.ForeignKey('family_users.id'), primary_key=True)
+    activity_id = db.Column(db.String(50), db.ForeignKey('activities.id'), primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_favorites_family_created', 'family_id', 'created_at', 'activity_id'),
+    )
+    
+    def to_dict(self):
+        return {
+            'familyId': self.family_id,
+            'activityId': self.activity_id,
+            'createdAt': self.created_at,
+        }
+
+def backfill_favorites():
+    """Move legacy favorite_activities JSON arrays into the favorites table"""
+    families = FamilyUser.query.filter(
+        FamilyUser.favorite_activities.isnot(None),
+        FamilyUser.favorite_activities != '[]',
+    ).all()
+    for family in families:
+        legacy = [a for a in load_json_list(family.favorite_activities) if isinstance(a, str)]
+        family.set_favorites(family.favorite_ids() + legacy)
+        # Cleared so that favorites removed later are not resurrected on restart
+        family.favorite_activities = None
+    db.session.commit()
+    return len(families)
+
+class ActivityRevision(db.Model):
+    __tablename__ = 'activity_revisions'
+    
+    activity_id = db.Column(db.String(50), db.ForeignKey('activities.id'), primary_key=True)
+    revision = db.Column(db.Integer, primary_key=True)
+    is_snapshot = db.Column(db.Boolean, nullable=False, default=False)
+    payload = db.Column(db.LargeBinary, nullable=False)  # zlib-compressed JSON state or delta
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_activity_revisions_snapshots', 'activity_id', 'is_snapshot', 'revision'),
+    )
+    
+    def to_dict(self):
+        return {
+            'activityId': self.activity_id,
+            'revision': self.revision,
+            'kind': 'snapshot' if self.is_snapshot else 'delta',
+            'size': len(self.payload) if self.payload else 0,
+            'createdAt': self.created_at,
+        }
+
+class ActivityTombstone(db.Model):
+    __tablename__ = 'activity_tombstones'
+    
+    # Deleted activities, so offline devices can drop their copies on next sync
+    activity_id = db.Column(db.String(50), primary_key=True)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+    
+    def to_dict(self):
+        return {
+            'activityId': self.activity_id,
+            'deletedAt': self.deleted_at,
+        }
+
 class Purchase(db.Model):
     __tablename__ = 'purchases'
     
     id = db.Column(db.String(50), primary_key=True)
     user_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=False)
-    activity_id = db.Column(db.String(50), db.ForeignKey('activities.id'), nullable=False)
+    # activity_id has no foreign key so purchases survive activity deletion
+    activity_id = db.Column(db.String(50), nullable=False)
     price = db.Column(db.Float, nullable=False)
     purchased_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_purchases_user_purchased', 'user_id', 'purchased_at'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
             'userId': self.user_id,
             'activityId': self.activity_id,
             'price': self.price,
-            'purchasedAt': self.purchased_at.isoformat() if self.purchased_at else None,
+            'purchasedAt': self.purchased_at,
+        }
+
+class SalesRollup(db.Model):
+    __tablename__ = 'sales_rollups'
+    
+    # activity_id has no foreign key so sales history survives activity deletion
+    activity_id = db.Column(db.String(50), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    tutor_id = db.Column(db.String(50), db.ForeignKey('users.id'), nullable=False)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
+    
+    __table_args__ = (
+        db.Index('ix_sales_rollups_tutor_day', 'tutor_id', 'day'),
+    )
+    
+    def to_dict(self):
+        return {
+            'tutorId': self.tutor_id,
+            'activityId': self.activity_id,
+            'day': self.day,
+            'units': self.units,
+            'revenue': self.revenue,
+        }
+
+class RatingHistogram(db.Model):
+    __tablename__ = 'rating_histograms'
+    
+    activity_id = db.Column(db.String(50), db.ForeignKey('activities.id'), primary_key=True)
+    stars_1 = db.Column(db.Integer, nullable=False, default=0)
+    stars_2 = db.Column(db.Integer, nullable=False, default=0)
+    stars_3 = db.Column(db.Integer, nullable=False, default=0)
+    stars_4 = db.Column(db.Integer, nullable=False, default=0)
+    stars_5 = db.Column(db.Integer, nullable=False, default=0)
+    
+    def counts(self):
+        return {stars: getattr(self, f'stars_{stars}') or 0 for stars in range(1, 6)}
+    
+    @classmethod
+    def record(cls, activity_id, rating):
+        """Atomically count one more review with the given rating; the caller commits"""
+        increment_counters(cls, {'activity_id': activity_id}, {f'stars_{rating}': 1})
+        return db.session.get(cls, activity_id, populate_existing=True)
+    
+    def to_dict(self):
+        counts = self.counts()
+        total = sum(counts.values())
+        return {
+            'activityId': self.activity_id,
+            'counts': {str(stars): count for stars, count in counts.items()},
+            'total': total,
+            'average': sum(stars * count for stars, count in counts.items()) / total if total else 0.0,
         }
 
 class Review(db.Model):
@@ -177,6 +521,10 @@ class Review(db.Model):
     comment = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_reviews_activity_created', 'activity_id', 'created_at', 'id'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -185,6 +533,6 @@ class Review(db.Model):
             'userName': self.user_name,
             'rating': self.rating,
             'comment': self.comment,
-            'createdAt': self.created_at.isoformat() if self.created_at else None,
+            'createdAt': self.created_at,
         }
 
@@ -0,0 +1,54 @@
+"""
+Keyset pagination helpers.
+
+Cursors are opaque, URL-safe tokens holding the (timestamp, id) sort key of
+the last row on a page, so each page is an indexed range scan rather than an
+OFFSET over everything before it.
+"""
+import base64
+from datetime import datetime
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def page_size(args, default=DEFAULT_PAGE_SIZE):
+    """Read ?limit= clamped to [1, MAX_PAGE_SIZE]"""
+    limit = args.get('limit', default, type=int) or default
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def encode_cursor(timestamp, row_id):
+    raw = f'{timestamp.isoformat()}|{row_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (timestamp, id) from a cursor, raising ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, row_id = raw.split('|', 1)
+        return datetime.fromisoformat(timestamp), row_id
+    except (UnicodeDecodeError, ValueError, TypeError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def keyset_page(query, timestamp_column, id_column, cursor, limit):
+    """
+    Apply a newest-first keyset page to query.
+
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        query = query.filter(
+            (timestamp_column < timestamp) |
+            ((timestamp_column == timestamp) & (id_column < row_id))
+        )
+    rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, timestamp_column.key), getattr(last, id_column.key))
+    return rows, next_cursor
@@ -0,0 +1,358 @@
+"""
+In-memory recommendation index for similar activities and family recommendations.
+
+The index is built lazily from the database on first use and kept up to date
+incrementally by the publish, update, delete, purchase and review routes, so
+queries only touch the activities that share features or buyers with the seed.
+
+Each worker process holds its own index. At most every
+RECOMMENDATION_REFRESH_SECONDS a query first catches up on activities,
+purchases and deletions committed since its high-water marks (minus a short
+overlap for late commits), so writes served by other workers show up too.
+"""
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from datetime import timedelta
+import math
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func
+
+from models import db, Activity, ActivityTombstone, Purchase, load_json_list
+
+# Relative weight of each metadata field in the activity vectors
+FIELD_WEIGHTS = {
+    'goal': 3.0,
+    'diag': 2.0,
+    'tag': 1.5,
+    'type': 1.0,
+    'lang': 0.5,
+}
+
+# Fields whose postings are selective enough to generate candidates from.
+# Type and language postings cover most of the catalogue and are only used
+# for scoring, or as a fallback when nothing more specific matches.
+CANDIDATE_FIELDS = ('goal', 'diag', 'tag')
+
+# Weight of the co-purchase signal relative to content similarity
+CO_PURCHASE_WEIGHT = 0.5
+
+# Rows this much older than a high-water mark are re-read on catch-up, so
+# transactions that commit after a later-stamped one are not missed
+CATCH_UP_OVERLAP = timedelta(seconds=60)
+
+
+def activity_features(activity):
+    """Build the sparse feature vector {feature: weight} for an activity"""
+    vector = {}
+    fields = (
+        ('goal', load_json_list(activity.therapy_goals)),
+        ('diag', load_json_list(activity.diagnosis_tags)),
+        ('tag', load_json_list(activity.tags)),
+        ('type', [activity.type] if activity.type else []),
+        ('lang', [activity.language] if activity.language else []),
+    )
+    for field, values in fields:
+        for value in values:
+            if not isinstance(value, str) or not value.strip():
+                continue
+            vector[f'{field}:{value.strip().lower()}'] = FIELD_WEIGHTS[field]
+    return vector
+
+
+class RecommendationIndex:
+    """Inverted index and co-purchase graph over published activities"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._vectors = {}                     # activity_id -> {feature: weight}
+        self._meta = {}                        # activity_id -> (age_min, age_max, purchase_count, rating)
+        self._postings = defaultdict(set)      # feature -> {activity_id}
+        self._co_purchases = defaultdict(Counter)  # activity_id -> Counter(activity_id)
+        self._buyer_count = Counter()          # activity_id -> distinct buyers
+        self._user_purchases = defaultdict(set)    # user_id -> {activity_id}
+        self._popularity = []                  # sorted [(-purchase_count, -rating, activity_id)]
+        self._marks = {}                       # table -> latest timestamp applied
+        self._next_refresh = 0.0
+
+    # ---------- maintenance ----------
+
+    def reset(self):
+        with self._lock:
+            self.__init__()
+
+    def ensure_loaded(self):
+        """Build the index from the database once per process"""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._marks = self._high_water_marks()
+            for activity in Activity.query.filter_by(is_published=True).all():
+                self._add_activity(activity)
+            rows = db.session.query(Purchase.user_id, Purchase.activity_id).all()
+            for user_id, activity_id in rows:
+                self._add_purchase(user_id, activity_id)
+            self._loaded = True
+            self._next_refresh = time.monotonic() + self._refresh_interval()
+
+    def ensure_fresh(self):
+        """Load the index, then catch up on other workers' writes if a refresh is due"""
+        self.ensure_loaded()
+        if time.monotonic() < self._next_refresh:
+            return
+        with self._lock:
+            if time.monotonic() < self._next_refresh:
+                return
+            self._catch_up()
+            self._next_refresh = time.monotonic() + self._refresh_interval()
+
+    @staticmethod
+    def _refresh_interval():
+        return current_app.config.get('RECOMMENDATION_REFRESH_SECONDS', 5)
+
+    @staticmethod
+    def _high_water_marks():
+        return {
+            'activities': db.session.query(func.max(Activity.updated_at)).scalar(),
+            'purchases': db.session.query(func.max(Purchase.purchased_at)).scalar(),
+            'tombstones': db.session.query(func.max(ActivityTombstone.deleted_at)).scalar(),
+        }
+
+    def _catch_up(self):
+        """Apply rows changed since the high-water marks (idempotent)"""
+        marks = self._high_water_marks()
+
+        def changed(query, column, table):
+            since = self._marks.get(table)
+            return query.filter(column > since - CATCH_UP_OVERLAP) if since else query
+
+        if marks['activities'] != self._marks.get('activities'):
+            for activity in changed(Activity.query, Activity.updated_at, 'activities'):
+                self._remove_activity(activity.id)
+                if activity.is_published:
+                    self._add_activity(activity)
+        if marks['purchases'] != self._marks.get('purchases'):
+            query = db.session.query(Purchase.user_id, Purchase.activity_id)
+            for user_id, activity_id in changed(query, Purchase.purchased_at, 'purchases'):
+                self._add_purchase(user_id, activity_id)
+        if marks['tombstones'] != self._marks.get('tombstones'):
+            query = db.session.query(ActivityTombstone.activity_id)
+            for (activity_id,) in changed(query, ActivityTombstone.deleted_at, 'tombstones'):
+                self._forget_activity(activity_id)
+        self._marks = marks
+
+    # Writes take the lock before checking _loaded, so a write committed while
+    # another thread is loading waits for the load and is then applied
+
+    def index_activity(self, activity):
+        """Add or refresh an activity after it is published, edited or reviewed"""
+        with self._lock:
+            if not self._loaded:
+                return
+            self._remove_activity(activity.id)
+            if activity.is_published:
+                self._add_activity(activity)
+
+    def remove_activity(self, activity_id):
+        with self._lock:
+            if self._loaded:
+                self._forget_activity(activity_id)
+
+    def record_purchase(self, user_id, activity_id):
+        """Update the co-purchase graph after a purchase is committed"""
+        with self._lock:
+            # Already applied by a catch-up, which also reloaded purchase_count
+            if not self._loaded or not self._add_purchase(user_id, activity_id):
+                return
+            meta = self._meta.get(activity_id)
+            if meta:
+                age_min, age_max, purchase_count, rating = meta
+                self._unrank(activity_id, meta)
+                self._meta[activity_id] = (age_min, age_max, purchase_count + 1, rating)
+                insort(self._popularity, (-(purchase_count + 1), -rating, activity_id))
+
+    def _add_activity(self, activity):
+        vector = activity_features(activity)
+        self._vectors[activity.id] = vector
+        self._meta[activity.id] = (
+            activity.age_min,
+            activity.age_max,
+            activity.purchase_count or 0,
+            activity.rating or 0.0,
+        )
+        insort(self._popularity, (-(activity.purchase_count or 0), -(activity.rating or 0.0), activity.id))
+        for feature in vector:
+            self._postings[feature].add(activity.id)
+
+    def _forget_activity(self, activity_id):
+        """Drop a deleted activity from the vectors and the purchase graph"""
+        self._remove_activity(activity_id)
+        for co_counts in self._co_purchases.values():
+            co_counts.pop(activity_id, None)
+        self._co_purchases.pop(activity_id, None)
+        self._buyer_count.pop(activity_id, None)
+        for purchased in self._user_purchases.values():
+            purchased.discard(activity_id)
+
+    def _remove_activity(self, activity_id):
+        vector = self._vectors.pop(activity_id, None)
+        meta = self._meta.pop(activity_id, None)
+        if meta:
+            self._unrank(activity_id, meta)
+        if not vector:
+            return
+        for feature in vector:
+            posting = self._postings.get(feature)
+            if posting is not None:
+                posting.discard(activity_id)
+                if not posting:
+                    del self._postings[feature]
+
+    def _unrank(self, activity_id, meta):
+        key = (-meta[2], -meta[3], activity_id)
+        position = bisect_left(self._popularity, key)
+        if position < len(self._popularity) and self._popularity[position] == key:
+            del self._popularity[position]
+
+    def _add_purchase(self, user_id, activity_id):
+        """Add a purchase to the graph; False if it was already there"""
+        purchased = self._user_purchases[user_id]
+        if activity_id in purchased:
+            return False
+        for other_id in purchased:
+            self._co_purchases[activity_id][other_id] += 1
+            self._co_purchases[other_id][activity_id] += 1
+        purchased.add(activity_id)
+        self._buyer_count[activity_id] += 1
+        return True
+
+    # ---------- scoring ----------
+
+    def _idf(self, feature):
+        total = len(self._vectors) or 1
+        return math.log(1 + total / (1 + len(self._postings.get(feature, ()))))
+
+    def _weighted(self, vector):
+        return {feature: weight * self._idf(feature) for feature, weight in vector.items()}
+
+    @staticmethod
+    def _cosine(query, query_norm, vector):
+        dot = 0.0
+        norm = 0.0
+        for feature, weight in vector.items():
+            norm += weight * weight
+            dot += query.get(feature, 0.0) * weight
+        if not dot or not query_norm or not norm:
+            return 0.0
+        return dot / (query_norm * math.sqrt(norm))
+
+    def _candidates(self, vector, co_counts, limit):
+        candidates = set(co_counts)
+        for feature in vector:
+            if feature.split(':', 1)[0] in CANDIDATE_FIELDS:
+                candidates |= self._postings.get(feature, set())
+        if len(candidates) < limit:
+            for feature in vector:
+                if feature.startswith('type:'):
+                    candidates |= self._postings.get(feature, set())
+        return candidates
+
+    def _rank(self, query_vector, co_counts, seed_buyers, exclude, limit, child_age=None):
+        query = self._weighted(query_vector)
+        query_norm = math.sqrt(sum(weight * weight for weight in query.values()))
+        scored = []
+        for candidate_id in self._candidates(query_vector, co_counts, limit):
+            if candidate_id in exclude or candidate_id not in self._vectors:
+                continue
+            if child_age is not None and not self._age_fits(candidate_id, child_age):
+                continue
+            score = self._cosine(query, query_norm, self._weighted(self._vectors[candidate_id]))
+            shared = co_counts.get(candidate_id)
+            if shared:
+                # Cosine over buyer sets: shared / sqrt(|A| * |B|)
+                denominator = math.sqrt(seed_buyers * self._buyer_count[candidate_id]) or 1
+                score += CO_PURCHASE_WEIGHT * min(1.0, shared / denominator)
+            if score > 0:
+                scored.append((score, self._meta[candidate_id][2], candidate_id))
+        scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+        return [(activity_id, score) for score, _, activity_id in scored[:limit]]
+
+    def _age_fits(self, activity_id, child_age):
+        age_min, age_max = self._meta[activity_id][:2]
+        if age_min is not None and child_age < age_min:
+            return False
+        if age_max is not None and child_age > age_max:
+            return False
+        return True
+
+    # ---------- queries ----------
+
+    def similar(self, activity_id, limit=10):
+        """Return [(activity_id, score)] of published activities similar to activity_id"""
+        self.ensure_fresh()
+        with self._lock:
+            vector = self._vectors.get(activity_id)
+            if vector is None:
+                activity = Activity.query.get(activity_id)
+                if activity is None:
+                    return None
+                vector = activity_features(activity)
+            co_counts = self._co_purchases.get(activity_id, Counter())
+            return self._rank(
+                vector,
+                co_counts,
+                self._buyer_count[activity_id],
+                exclude={activity_id},
+                limit=limit,
+            )
+
+    def recommend_for_family(self, family, limit=10):
+        """Return [(activity_id, score)] for a family based on favorites and purchases"""
+        self.ensure_fresh()
+        favorites = set(family.favorite_ids())
+        with self._lock:
+            purchased = set(self._user_purchases.get(family.id, ()))
+            seeds = purchased | favorites
+
+            profile = Counter()
+            co_counts = Counter()
+            for seed_id in seeds:
+                for feature, weight in self._vectors.get(seed_id, {}).items():
+                    profile[feature] += weight
+                co_counts.update(self._co_purchases.get(seed_id, {}))
+            seed_buyers = max(1, sum(self._buyer_count[seed_id] for seed_id in seeds))
+
+            results = []
+            if profile or co_counts:
+                results = self._rank(
+                    dict(profile),
+                    co_counts,
+                    seed_buyers,
+                    exclude=purchased,
+                    limit=limit,
+                    child_age=family.child_age,
+                )
+            if len(results) < limit:
+                results.extend(self._popular(family.child_age, purchased | {r[0] for r in results},
+                                             limit - len(results)))
+            return results
+
+    def _popular(self, child_age, exclude, limit):
+        """Walk the maintained popularity order until limit activities qualify"""
+        results = []
+        for _, _, activity_id in self._popularity:
+            if len(results) >= limit:
+                break
+            if activity_id in exclude:
+                continue
+            if child_age is not None and not self._age_fits(activity_id, child_age):
+                continue
+            results.append((activity_id, 0.0))
+        return results
+
+recommendation_index = RecommendationIndex()
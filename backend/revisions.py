@@ -0,0 +1,219 @@
+"""
+Activity revision history.
+
+Each saved change to an activity's content becomes a revision. Every
+REVISION_SNAPSHOT_INTERVAL-th revision stores the full state; the ones in
+between store a delta against the previous revision (changed fields, plus
+upserted/removed canvas elements keyed by element id). Reconstructing any
+revision therefore reads one snapshot and at most interval - 1 deltas.
+"""
+from datetime import datetime, timedelta
+import json
+import zlib
+
+from flask import current_app
+
+from models import db, ActivityRevision
+
+# Activity columns captured in a revision, mapped to their state keys
+TRACKED_FIELDS = {
+    'title': 'title',
+    'description': 'description',
+    'language': 'language',
+    'elements': 'elements',
+    'tags': 'tags',
+}
+JSON_FIELDS = ('elements', 'tags')
+
+
+def _pack(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+
+
+def _unpack(payload):
+    return json.loads(zlib.decompress(payload))
+
+
+def activity_state(activity):
+    state = {}
+    for column, key in TRACKED_FIELDS.items():
+        value = getattr(activity, column)
+        state[key] = json.loads(value) if column in JSON_FIELDS and value else value
+    if state['elements'] is None:
+        state['elements'] = []
+    return state
+
+
+def _element_ids(elements):
+    """Element ids in order, or None if any is missing, duplicated or not a string"""
+    ids = [e.get('id') if isinstance(e, dict) else None for e in elements]
+    # Upserts are stored as a JSON object keyed by id, which only round-trips string keys
+    if not all(isinstance(element_id, str) for element_id in ids) or len(set(ids)) != len(ids):
+        return None
+    return ids
+
+
+def diff_states(old, new):
+    """Return a delta turning old into new, or None if they are equal"""
+    delta = {}
+    for key in TRACKED_FIELDS.values():
+        if key != 'elements' and old.get(key) != new.get(key):
+            delta.setdefault('fields', {})[key] = new.get(key)
+
+    old_elements, new_elements = old.get('elements') or [], new.get('elements') or []
+    if old_elements != new_elements:
+        old_ids, new_ids = _element_ids(old_elements), _element_ids(new_elements)
+        if old_ids is None or new_ids is None:
+            delta['elements'] = new_elements
+        else:
+            previous = dict(zip(old_ids, old_elements))
+            kept = set(new_ids)
+            upsert = {e['id']: e for e in new_elements if previous.get(e['id']) != e}
+            removed = [element_id for element_id in old_ids if element_id not in kept]
+            delta['elementDelta'] = {'upsert': upsert, 'remove': removed}
+            # Only store the order when it differs from "survivors, then additions"
+            default_order = [i for i in old_ids if i in kept] + [i for i in new_ids if i not in previous]
+            if new_ids != default_order:
+                delta['elementDelta']['order'] = new_ids
+
+    return delta or None
+
+
+def apply_delta(state, delta):
+    state = dict(state, **delta.get('fields', {}))
+    if 'elements' in delta:
+        state['elements'] = delta['elements']
+    elif 'elementDelta' in delta:
+        element_delta = delta['elementDelta']
+        removed = set(element_delta.get('remove', []))
+        elements = {e['id']: e for e in state['elements'] if e['id'] not in removed}
+        elements.update(element_delta.get('upsert', {}))
+        order = element_delta.get('order') or list(elements)
+        state['elements'] = [elements[element_id] for element_id in order]
+    return state
+
+
+def _snapshot_interval():
+    return current_app.config.get('REVISION_SNAPSHOT_INTERVAL', 20)
+
+
+def _chain(activity_id, revision=None):
+    """Rows from the nearest snapshot up to revision (or the latest), oldest first"""
+    query = ActivityRevision.query.filter_by(activity_id=activity_id)
+    if revision is not None:
+        query = query.filter(ActivityRevision.revision <= revision)
+    snapshot = (
+        query.filter_by(is_snapshot=True)
+        .order_by(ActivityRevision.revision.desc())
+        .first()
+    )
+    if snapshot is None:
+        return []
+    return query.filter(ActivityRevision.revision >= snapshot.revision).order_by(ActivityRevision.revision).all()
+
+
+def _replay(rows):
+    state = None
+    for row in rows:
+        data = _unpack(row.payload)
+        state = data if row.is_snapshot else apply_delta(state, data)
+    return state
+
+
+def revision_state(activity_id, revision=None):
+    """Reconstruct the state at a revision (default latest), or None if it does not exist"""
+    rows = _chain(activity_id, revision)
+    if not rows or (revision is not None and rows[-1].revision != revision):
+        return None
+    return _replay(rows)
+
+
+def record_revision(activity):
+    """Store the activity's current content as a new revision; the caller commits"""
+    rows = _chain(activity.id)
+    state = activity_state(activity)
+    if not rows:
+        latest = ActivityRevision.query.filter_by(activity_id=activity.id).order_by(
+            ActivityRevision.revision.desc()).first()
+        number = latest.revision + 1 if latest else 1
+        db.session.add(ActivityRevision(activity_id=activity.id, revision=number, is_snapshot=True, payload=_pack(state)))
+        return number
+
+    delta = diff_states(_replay(rows), state)
+    if delta is None:
+        return None
+    number = rows[-1].revision + 1
+    if len(rows) >= _snapshot_interval():
+        db.session.add(ActivityRevision(activity_id=activity.id, revision=number, is_snapshot=True, payload=_pack(state)))
+    else:
+        db.session.add(ActivityRevision(activity_id=activity.id, revision=number, is_snapshot=False, payload=_pack(delta)))
+    return number
+
+
+def ensure_base_revision(activity):
+    """Capture the pre-edit content of activities that predate revision history"""
+    if not ActivityRevision.query.filter_by(activity_id=activity.id).first():
+        record_revision(activity)
+
+
+def restore_revision(activity, state):
+    """
+    Copy a reconstructed revision state back onto the activity and record it as
+    a new revision. Returns the new revision number, or None if nothing changed.
+    """
+    for column, key in TRACKED_FIELDS.items():
+        value = state.get(key)
+        if column == 'elements' and value is None:
+            value = []
+        if column in JSON_FIELDS and value is not None:
+            value = json.dumps(value)
+        setattr(activity, column, value)
+    activity.mark_content_changed()
+    return record_revision(activity)
+
+
+def compact_revisions(activity_id, now=None):
+    """
+    Thin revisions older than REVISION_RETENTION_DAYS to the last one per day,
+    then re-encode the surviving chain. Returns the number of rows removed.
+    """
+    rows = ActivityRevision.query.filter_by(activity_id=activity_id).order_by(ActivityRevision.revision).all()
+    if not rows:
+        return 0
+    cutoff = (now or datetime.utcnow()) - timedelta(days=current_app.config.get('REVISION_RETENTION_DAYS', 30))
+
+    # Keep everything recent, plus the latest revision of each older day
+    last_per_day = {}
+    for row in rows:
+        if row.created_at < cutoff:
+            last_per_day[row.created_at.date()] = row.revision
+    keep = {row.revision for row in rows if row.created_at >= cutoff} | set(last_per_day.values())
+    if len(keep) == len(rows):
+        return 0
+
+    states = []
+    state = None
+    for row in rows:
+        data = _unpack(row.payload)
+        state = data if row.is_snapshot else apply_delta(state, data)
+        if row.revision in keep:
+            states.append((row.revision, row.created_at, state))
+
+    for row in rows:
+        db.session.delete(row)
+    db.session.flush()
+
+    interval = _snapshot_interval()
+    previous = None
+    for index, (revision, created_at, state) in enumerate(states):
+        is_snapshot = index % interval == 0
+        payload = _pack(state if is_snapshot else (diff_states(previous, state) or {}))
+        db.session.add(ActivityRevision(
+            activity_id=activity_id,
+            revision=revision,
+            is_snapshot=is_snapshot,
+            payload=payload,
+            created_at=created_at,
+        ))
+        previous = state
+    return len(rows) - len(states)
@@ -0,0 +1,127 @@
+"""
+Daily tutor sales rollups.
+
+create_purchase bumps one (activity, day) row in the same transaction as the
+purchase, so earnings dashboards read a handful of rollup rows per day in the
+requested range instead of scanning the purchase history.
+"""
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+
+from models import db, Activity, Purchase, SalesRollup, increment_counters
+
+GRANULARITIES = ('day', 'week', 'month')
+
+
+def record_sale(purchase, activity):
+    """Add a purchase to its daily rollup row; the caller commits"""
+    increment_counters(
+        SalesRollup,
+        keys={'activity_id': activity.id, 'day': purchase.purchased_at.date()},
+        increments={'units': 1, 'revenue': purchase.price},
+        values={'tutor_id': activity.author_id},
+    )
+
+
+def rebuild_sales_rollups():
+    """
+    Recompute every rollup row from the purchases table in one transaction.
+    The rollup rows are locked (deleted) before purchases are read, so a
+    purchase committing concurrently either is read here or waits and then
+    increments the rebuilt row; none is lost or counted twice.
+    """
+    if db.engine.dialect.name == 'postgresql':
+        # A bare DELETE does not stop concurrent upserts of new (activity, day) rows
+        db.session.execute(text('LOCK TABLE sales_rollups IN EXCLUSIVE MODE'))
+    # Deleted activities keep the tutor recorded in their existing rollups
+    authors = dict(db.session.query(SalesRollup.activity_id, SalesRollup.tutor_id).distinct().all())
+    SalesRollup.query.delete()
+
+    totals = defaultdict(lambda: [0, 0.0])
+    rows = (
+        db.session.query(Purchase.activity_id, Activity.author_id, Purchase.purchased_at, Purchase.price)
+        .outerjoin(Activity, Activity.id == Purchase.activity_id)
+        .yield_per(1000)
+    )
+    for activity_id, author_id, purchased_at, price in rows:
+        if purchased_at is None:
+            continue
+        if author_id is not None:
+            authors[activity_id] = author_id
+        key = (activity_id, purchased_at.date())
+        totals[key][0] += 1
+        totals[key][1] += price or 0.0
+
+    db.session.add_all(
+        SalesRollup(activity_id=activity_id, day=day, tutor_id=authors[activity_id], units=units, revenue=revenue)
+        for (activity_id, day), (units, revenue) in totals.items()
+        if authors.get(activity_id)
+    )
+    db.session.commit()
+    return len(totals)
+
+
+def backfill_sales_rollups():
+    """Build the rollups once for a database whose purchases predate them"""
+    if SalesRollup.query.first() is not None or Purchase.query.first() is None:
+        return 0
+    return rebuild_sales_rollups()
+
+
+def _period_start(day, granularity):
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def tutor_sales(tutor_id, start, end, granularity='day'):
+    """Aggregate a tutor's rollup rows between start and end (inclusive)"""
+    rows = SalesRollup.query.filter(
+        SalesRollup.tutor_id == tutor_id,
+        SalesRollup.day >= start,
+        SalesRollup.day <= end,
+    ).order_by(SalesRollup.day).all()
+
+    series = OrderedDict()
+    by_activity = defaultdict(lambda: {'units': 0, 'revenue': 0.0})
+    for row in rows:
+        period = series.setdefault(_period_start(row.day, granularity), {'units': 0, 'revenue': 0.0})
+        period['units'] += row.units
+        period['revenue'] += row.revenue
+        by_activity[row.activity_id]['units'] += row.units
+        by_activity[row.activity_id]['revenue'] += row.revenue
+
+    return {
+        'tutorId': tutor_id,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'granularity': granularity,
+        'series': [
+            {'period': period.isoformat(), 'units': totals['units'], 'revenue': round(totals['revenue'], 2)}
+            for period, totals in series.items()
+        ],
+        'activities': [
+            {'activityId': activity_id, 'units': totals['units'], 'revenue': round(totals['revenue'], 2)}
+            for activity_id, totals in sorted(by_activity.items(), key=lambda item: -item[1]['revenue'])
+        ],
+        'totals': {
+            'units': sum(totals['units'] for totals in series.values()),
+            'revenue': round(sum(totals['revenue'] for totals in series.values()), 2),
+        },
+    }
+
+
+def parse_sales_range(args):
+    """Read from/to (ISO dates, default last 30 UTC days) and granularity from query args"""
+    end = date.fromisoformat(args['to']) if args.get('to') else datetime.utcnow().date()
+    start = date.fromisoformat(args['from']) if args.get('from') else end - timedelta(days=29)
+    granularity = args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+    if start > end:
+        raise ValueError("'from' must not be after 'to'")
+    return start, end, granularity
@@ -0,0 +1,147 @@
+"""
+Incremental offline sync bundles for a user's purchased activities.
+
+A bundle is newline-delimited JSON, gzip-compressed while it streams:
+
+    {"type": "header", "since": ..., "watermark": ...}
+    {"type": "asset", "id": ..., "content": ...}       # once per asset the device lacks
+    {"type": "activity", "activity": {...}}            # elements reference assets by id
+    {"type": "tombstone", "activityId": ..., "deletedAt": ...}
+    {"type": "end", "watermark": ..., "activities": n, "assets": n, "tombstones": n}
+
+Only activities whose content changed (Activity.content_updated_at, which
+purchase and review counters do not touch) or that were purchased after
+`since` are included, so the cost of a sync follows the number of changes to
+the library rather than its size or marketplace traffic.
+Devices store the returned watermark and send it back as `since` next time.
+The watermark lags the start of the sync by SYNC_WATERMARK_OVERLAP seconds so
+writes that commit while a bundle is being built are picked up next time;
+records may therefore repeat across bundles and are applied idempotently.
+
+Asset ids are content hashes. Devices send the ids they already hold as
+known_assets, and only missing assets are included.
+"""
+from datetime import datetime, timedelta
+import hashlib
+import zlib
+
+from flask import current_app
+
+from author_cache import profile_cache
+from models import db, Activity, ActivityTombstone, Purchase
+
+# Element types whose content is a (possibly inline) media asset
+ASSET_ELEMENT_TYPES = ('image', 'audio')
+
+# Activities loaded (and authors batch-loaded) per round trip
+SYNC_BATCH_SIZE = 100
+
+
+def parse_watermark(value):
+    """Parse an ISO watermark; None means a full sync"""
+    return datetime.fromisoformat(value) if value else None
+
+
+def _line(record):
+    return current_app.json.dumps(record) + '\n'
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _extract_assets(activity_dict, seen):
+    """Replace media element content with asset ids; return newly seen assets"""
+    new_assets = []
+    for element in activity_dict.get('elements', []):
+        if not isinstance(element, dict) or element.get('type') not in ASSET_ELEMENT_TYPES:
+            continue
+        content = element.get('content')
+        if not content:
+            continue
+        asset_id = hashlib.sha1(content.encode()).hexdigest()
+        if asset_id not in seen:
+            seen.add(asset_id)
+            new_assets.append({'type': 'asset', 'id': asset_id, 'content': content})
+        element['assetId'] = asset_id
+        del element['content']
+    return new_assets
+
+
+def parse_known_assets(values):
+    """Normalize asset ids sent by the device (a list or comma-separated strings)"""
+    known = set()
+    for value in values or ():
+        if isinstance(value, str):
+            known.update(asset_id.strip() for asset_id in value.split(',') if asset_id.strip())
+    return known
+
+
+def sync_records(user_id, since, known_assets=()):
+    """Yield the bundle records for user_id changed after since, omitting known_assets"""
+    overlap = timedelta(seconds=current_app.config.get('SYNC_WATERMARK_OVERLAP', 60))
+    watermark = datetime.utcnow() - overlap
+    yield _line({
+        'type': 'header',
+        'userId': user_id,
+        'since': since,
+        'watermark': watermark,
+    })
+
+    query = (
+        db.session.query(Activity)
+        .join(Purchase, Purchase.activity_id == Activity.id)
+        .filter(Purchase.user_id == user_id)
+    )
+    if since:
+        query = query.filter((Activity.content_updated_at > since) | (Purchase.purchased_at > since))
+
+    seen_assets = set(known_assets)
+    asset_count = 0
+    activity_count = 0
+    for batch in _batches(query.distinct().yield_per(SYNC_BATCH_SIZE), SYNC_BATCH_SIZE):
+        profile_cache.warm(batch)
+        for activity in batch:
+            activity_dict = activity.to_dict(include_author=True)
+            for asset in _extract_assets(activity_dict, seen_assets):
+                yield _line(asset)
+                asset_count += 1
+            yield _line({'type': 'activity', 'activity': activity_dict})
+            activity_count += 1
+
+    tombstones = (
+        db.session.query(ActivityTombstone)
+        .join(Purchase, Purchase.activity_id == ActivityTombstone.activity_id)
+        .filter(Purchase.user_id == user_id)
+    )
+    if since:
+        tombstones = tombstones.filter(ActivityTombstone.deleted_at > since)
+    tombstone_count = 0
+    for tombstone in tombstones.distinct():
+        yield _line(dict(tombstone.to_dict(), type='tombstone'))
+        tombstone_count += 1
+
+    yield _line({
+        'type': 'end',
+        'watermark': watermark,
+        'activities': activity_count,
+        'assets': asset_count,
+        'tombstones': tombstone_count,
+    })
+
+
+def gzip_stream(chunks, level=6):
+    """Gzip-compress an iterable of text chunks as it is consumed"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()